@@ -1,11 +1,12 @@
 """Bisect a whole nixos + home-manager system"""
 
+import os
+import signal
 import tempfile
 import stat
 import time
 
 from subprocess import Popen, PIPE
-from multiprocessing import Process
 from pathlib import Path
 
 from nix_bisect import nix, test_util, git_bisect
@@ -78,25 +79,32 @@ class Sudoloop:
 
     def __init__(self, initialize=True):
         self.initialize = initialize
+        self.loop_pid = None
 
-        def sudoloop():
-            while True:
-                # Extend sudo cache by 5 minutes but do not re-query the user
-                # if the password is not already cached.
-                test_util.exit_code("sudo -S --validate </dev/null 2>/dev/null")
-                time.sleep(4 * 60)
-
-        self.loop_process = Process(target=sudoloop)
+    @staticmethod
+    def _sudoloop():
+        while True:
+            # Extend sudo cache by 5 minutes but do not re-query the user
+            # if the password is not already cached.
+            test_util.exit_code("sudo -S --validate </dev/null 2>/dev/null")
+            time.sleep(4 * 60)
 
     def __enter__(self):
         if self.initialize:
             # First initialize the cache in a blocking manner.
             test_util.exit_code("sudo --validate")
-        self.loop_process.start()
+        # A plain fork is enough here, there is no need for the machinery of
+        # multiprocessing.
+        self.loop_pid = os.fork()
+        if self.loop_pid == 0:
+            try:
+                self._sudoloop()
+            finally:
+                os._exit(0)
 
     def __exit__(self, _type, _value, _traceback):
-        self.loop_process.terminate()
-        self.loop_process.join()
+        os.kill(self.loop_pid, signal.SIGTERM)
+        os.waitpid(self.loop_pid, 0)
 
 
 if __name__ == "__main__":
@@ -13,33 +13,17 @@ class EnvSetupFailedException(Exception):
 def run_with_env(function, env_setup):
     """Run a function in a certain environment"""
 
-    def pick(rev):
-        success = git.try_cherry_pick_all(rev)
-        if not success:
-            raise EnvSetupFailedException("Cherry-pick failed")
-
-    action_to_function = {
-        "try_pick": git.try_cherry_pick_all,
-        "pick": pick,
-    }
-
     with git.git_checkpoint():
-        for (action, rev) in env_setup:
-            action_to_function[action](rev)
+        actions = [action for (action, _rev) in env_setup]
+        results = git.try_cherry_pick_all_batched(rev for (_action, rev) in env_setup)
+        for (action, (_rev, success)) in zip(actions, results):
+            if action == "pick" and not success:
+                raise EnvSetupFailedException("Cherry-pick failed")
 
         return function()
 
 
 def _main():
-    # Ordered list of actions to apply
-    class _AppendShared(argparse.Action):
-        def __call__(self, parser, namespace, values, option_string=None):
-            if not "setup_actions" in namespace:
-                setattr(namespace, "setup_actions", [])
-            previous = namespace.setup_actions
-            previous.append((self.dest, values))
-            setattr(namespace, "setup_actions", previous)
-
     parser = argparse.ArgumentParser(
         description="Run a program with a certain environment"
     )
@@ -49,15 +33,22 @@ def _main():
     parser.add_argument(
         "args", type=str, nargs=argparse.REMAINDER,
     )
+    # Both options append to the same ordered list of actions to apply.
     parser.add_argument(
         "--try-pick",
-        action=_AppendShared,
+        dest="setup_actions",
+        action="append",
+        type=lambda rev: ("try_pick", rev),
+        metavar="REV",
         default=[],
         help="Cherry pick a commit before building (only if it applies without issues).",
     )
     parser.add_argument(
         "--pick",
-        action=_AppendShared,
+        dest="setup_actions",
+        action="append",
+        type=lambda rev: ("pick", rev),
+        metavar="REV",
         default=[],
         help="Cherry pick a commit before building, abort on failure.",
     )
@@ -67,13 +58,11 @@ def _main():
     except SystemExit:
         git_bisect.abort()
 
-    setup_actions = args.setup_actions if hasattr(args, "setup_actions") else []
-
     def cmd():
         return subprocess.call([args.cmd] + args.args)
 
     try:
-        return run_with_env(cmd, setup_actions)
+        return run_with_env(cmd, args.setup_actions)
     except EnvSetupFailedException:
         print("Environment setup failed.")
         return 125
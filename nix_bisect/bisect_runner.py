@@ -1,8 +1,6 @@
 """A python reimplementation of git-bisect"""
 
-import subprocess
 from pathlib import Path
-import numpy as np
 from nix_bisect import git, git_bisect
 
 
@@ -78,78 +76,54 @@ def bisect_skip(commit):
     bisect_append_log(f"git bisect skip {git.rev_parse(commit)}")
 
 
-def get_good_commits():
-    """Returns all refs that are marked as good."""
+def _filter_prefix(refs, prefix):
+    """Filters a list of refs the same way `git.get_refs_with_prefix` does."""
+    return [ref for ref in refs if ref.startswith(prefix + "/")]
+
+
+def _filter_good(refs):
+    """Filters the refs that mark a commit as good from a list of refs."""
     good_refs = []
-    for ref in git.get_refs_with_prefix("refs/bisect"):
+    for ref in refs:
         parts = ref.split("/")
         if len(parts) == 3 and parts[2].startswith("good-"):
             good_refs.append(ref)
     return good_refs
 
 
+def get_good_commits():
+    """Returns all refs that are marked as good."""
+    return git.get_refs_matching("refs/bisect/good-*")
+
+
 def get_skip_range_commits(patchset):
     """Returns all refs that are marked with some skip range."""
-    return git.get_refs_with_prefix(
-        f"refs/bisect/break/{patchset_identifier(patchset)}/markers"
+    return git.get_refs_matching(
+        f"refs/bisect/break/{patchset_identifier(patchset)}/markers/*/*"
     )
 
 
 def within_range(commit, range_markers):
     """Whether or not a given commit is enclosed by a pair of range markers"""
-    reached_by_range = False
-    for marker in range_markers:
-        if git.is_ancestor(commit, marker):
-            reached_by_range = True
-            break
-    if not reached_by_range:
+    if len(git.refs_containing(commit, range_markers)) == 0:
         return False
-
-    can_reach_range = False
-    for marker in range_markers:
-        if git.is_ancestor(marker, commit):
-            can_reach_range = True
-            break
-    return can_reach_range
+    return len(git.refs_merged_into(commit, range_markers)) > 0
 
 
-def get_named_skip_refs(name, patchset):
-    """Returns all commits that are marked with the skip range `name`."""
-    return git.get_refs_with_prefix(
-        f"refs/bisect/break/{patchset_identifier(patchset)}/markers/{name}"
-    )
-
-
-def get_skip_ranges(patchset):
-    """Returns all skip range names"""
-    return {
-        ref.split("/")[-2]
-        for ref in git.get_refs_with_prefix(
-            f"refs/bisect/break/{patchset_identifier(patchset)}/markers"
-        )
-    }
-
-
-def refs_for_commit(commit):
-    """Returns all refs that point to a commit."""
-    lines = subprocess.check_output(["git", "show-ref"]).decode().splitlines()
-    result = dict()
-    for line in lines:
-        (target, ref) = line.split(" ")
-        new_set = result.get(target, set())
-        new_set.add(ref)
-        result[target] = new_set
-    return result.get(commit, [])
+def get_skip_range_markers(patchset):
+    """Returns a dict mapping each skip range name to its marker refs."""
+    markers = dict()
+    for ref in get_skip_range_commits(patchset):
+        markers.setdefault(ref.split("/")[-2], []).append(ref)
+    return markers
 
 
 def skip_ranges_of_commit(commit, patchset):
     """Returns all named skip ranges a commit is marked with."""
-    skip_ranges = []
-    for ref in refs_for_commit(commit):
-        if ref.startswith(f"refs/bisect/break/{patchset_identifier(patchset)}/markers"):
-            components = ref.split("/")
-            skip_ranges.append(components[-2])
-    return skip_ranges
+    markers = git.get_refs_pointing_at(
+        commit, f"refs/bisect/break/{patchset_identifier(patchset)}/markers"
+    )
+    return [ref.split("/")[-2] for ref in markers]
 
 
 def clear_refs_with_prefix(prefix):
@@ -158,15 +132,30 @@ def clear_refs_with_prefix(prefix):
         git.delete_ref(ref)
 
 
-def read_patchset():
-    """Reats the current (i.e. longest) patchset from the refs"""
-    patchset_refs = git.get_refs_with_prefix("refs/bisect/patchset")
+def _patchset_from_refs(patchset_refs):
+    """Determines the longest patchset from a list of patchset refs"""
     if len(patchset_refs) == 0:
         return []
     patchset_identifiers = [ref.split("/")[3:-1] for ref in patchset_refs]
-    longest_idx = np.argmax([len(ps) for ps in patchset_identifiers])
-    patchset = patchset_identifiers[longest_idx]
-    return patchset
+    return max(patchset_identifiers, key=len)
+
+
+# The last known patchset and the ref generation it was read at.
+_patchset_cache = (None, ())
+
+
+def _remember_patchset(patchset):
+    global _patchset_cache
+    _patchset_cache = (git.ref_generation(), tuple(patchset))
+
+
+def read_patchset():
+    """Reats the current (i.e. longest) patchset from the refs"""
+    (generation, patchset) = _patchset_cache
+    if generation != git.ref_generation():
+        patchset = _patchset_from_refs(git.get_refs_with_prefix("refs/bisect/patchset"))
+        _remember_patchset(patchset)
+    return list(patchset)
 
 
 def bisect_env_args(patchset):
@@ -177,18 +166,46 @@ def bisect_env_args(patchset):
     return args
 
 
-def first_not_skipped(commit_list):
-    """Returns the first commit of the list that is not marked as skipped"""
+def _skipped_commits(resolved_refs):
+    """Returns the commits that are marked as skipped in a list of
+    `(commit, ref)` pairs."""
+    return {
+        commit for (commit, ref) in resolved_refs if ref.startswith("refs/bisect/skip-")
+    }
+
+
+def first_not_skipped(commit_list, skipped_commits=None):
+    """Returns the first commit of the list that is not marked as skipped
+
+    The commits in `commit_list` have to be full hashes. `skipped_commits` can
+    be passed if the skipped commits are already known.
+    """
+    if skipped_commits is None:
+        skipped_commits = _skipped_commits(
+            git.get_resolved_refs_with_prefix("refs/bisect")
+        )
     for commit in commit_list:
-        is_skipped = False
-        for ref in refs_for_commit(commit):
-            if ref.startswith("refs/bisect/skip-"):
-                is_skipped = True
-        if not is_skipped:
+        if commit not in skipped_commits:
             return commit
     raise Exception("Cannot bisect any further")
 
 
+def _bisect_range(resolved_refs):
+    """Determines the current patchset and the range that is being bisected.
+
+    Returns a tuple `(patchset, good_refs, skip_range_refs, bad_commit)` from a
+    list of resolved `(commit, ref)` pairs.
+    """
+    bisect_refs = [ref for (_rev, ref) in resolved_refs]
+    patchset = _patchset_from_refs(_filter_prefix(bisect_refs, "refs/bisect/patchset"))
+    good_refs = _filter_good(bisect_refs)
+    skip_range_refs = _filter_prefix(
+        bisect_refs, f"refs/bisect/break/{patchset_identifier(patchset)}/markers"
+    )
+    bad_commit = {ref: rev for (rev, ref) in resolved_refs}["refs/bisect/bad"]
+    return (patchset, good_refs, skip_range_refs, bad_commit)
+
+
 class BisectRunner:
     """Runs a bisection"""
 
@@ -201,16 +218,23 @@ class BisectRunner:
         May add commits for cherry pick. Returns `False` when the bisect is
         finished.
         """
-        patchset = read_patchset()
-        considered_good = get_good_commits() + get_skip_range_commits(patchset)
-        candidates = git.get_bisect_all(considered_good, "refs/bisect/bad")
+        # List (and resolve) all bisect refs at once and filter them locally,
+        # instead of calling git for every kind of ref and every ref.
+        resolved_refs = git.get_resolved_refs_with_prefix("refs/bisect")
+        (patchset, good_refs, skip_range_refs, bad_commit) = _bisect_range(
+            resolved_refs
+        )
+        # Spares the next `read_patchset` from listing the refs again.
+        _remember_patchset(patchset)
+        considered_good = good_refs + skip_range_refs
+        candidates = git.get_bisect_all(considered_good, bad_commit)
         # It would be better to use a more sophisticated algorithm like
         # https://github.com/git/git/commit/ebc9529f0358bdb10192fa27bc75f5d4e452ce90
         # This works for now though.
-        commit = first_not_skipped(candidates)
-        if git.rev_parse(commit) == git.rev_parse("refs/bisect/bad"):
+        commit = first_not_skipped(candidates, _skipped_commits(resolved_refs))
+        if commit == bad_commit:
             skip_ranges = []
-            good_commits = [git.rev_parse(ref) for ref in get_good_commits()]
+            good_commits = [rev for (rev, ref) in resolved_refs if ref in good_refs]
             for parent in git.parents(commit):
                 if parent in good_commits:
                     print(f"First bad found! Here it is: {commit}")
@@ -222,19 +246,50 @@ class BisectRunner:
             return self.get_next()
         return commit
 
-    def _single_run(self, bisect_fun):
-        patchset = read_patchset()
+    def get_next_candidates(self, count):
+        """Computes up to `count` commits that can be tested in parallel.
+
+        One of them is the commit `get_next` would pick, the others are spread
+        evenly over the rest of the range. Testing all of them narrows the range
+        down by roughly log2(count + 1) steps at once. The candidates are
+        returned children first. An empty list means the bisect is finished.
+        """
+        first = self.get_next()
+        if first is None:
+            return []
+        # `get_next` may have extended the patchset, so read the refs again.
+        resolved_refs = git.get_resolved_refs_with_prefix("refs/bisect")
+        (_patchset, good_refs, skip_range_refs, bad_commit) = _bisect_range(
+            resolved_refs
+        )
+        skipped_commits = _skipped_commits(resolved_refs)
+        range_commits = git.bisect_range_commits(
+            bad_commit, good_refs + skip_range_refs
+        )
+        commits = [
+            commit
+            for commit in range_commits
+            if commit not in skipped_commits and commit != bad_commit
+        ]
+        if first not in commits:
+            return [first]
+        first_index = commits.index(first)
+        indices = {i * len(commits) // (count + 1) for i in range(1, count + 1)}
+        indices.remove(min(indices, key=lambda i: abs(i - first_index)))
+        indices.add(first_index)
+        return [commits[i] for i in sorted(indices)]
+
+    def _single_run(self, bisect_fun, patchset):
         with git.git_checkpoint():
             one_patch_succeeded = False
-            for (i, rev) in enumerate(patchset):
-                success = git.try_cherry_pick_all(rev)
+            results = git.try_cherry_pick_all_batched(patchset)
+            for (i, (_rev, success)) in enumerate(results):
                 one_patch_succeeded = success or one_patch_succeeded
                 if not one_patch_succeeded:
                     remaining_patchset = patchset[i + 1 :]
-                    for skip_range in get_skip_ranges(remaining_patchset):
-                        if within_range(
-                            "HEAD", get_named_skip_refs(skip_range, remaining_patchset)
-                        ):
+                    skip_range_markers = get_skip_range_markers(remaining_patchset)
+                    for (skip_range, range_markers) in skip_range_markers.items():
+                        if within_range("HEAD", range_markers):
                             print(
                                 f"Commit with remaining patches matches known skip range {skip_range}."
                             )
@@ -248,16 +303,20 @@ class BisectRunner:
             if next_commit is None:
                 return
             git.checkout(next_commit)
-            result = self._single_run(bisect_fun)
-            if result == "bad":
+            # The patchset only changes in `get_next`, so one read per step is
+            # enough.
+            patchset = read_patchset()
+            result = self._single_run(bisect_fun, patchset)
+            # Results are either "good", "bad" or "skip <reason>".
+            (status, _sep, reason) = result.partition(" ")
+            if status == "bad":
                 bisect_bad("HEAD")
                 git_bisect.print_bad()
-            elif result == "good":
+            elif status == "good":
                 bisect_good("HEAD")
                 git_bisect.print_good()
-            elif result.startswith("skip"):
-                reason = result[len("skip ") :]
+            elif status == "skip":
                 git_bisect.print_skip(reason)
-                named_skip(reason, read_patchset(), "HEAD")
+                named_skip(reason, patchset, "HEAD")
             else:
                 raise Exception("Unknown bisection result.")
@@ -39,25 +39,24 @@ def build_status(
     print(f"Querying status of {drv}.")
 
     try:
-        drv = Derivation(
+        with Derivation(
             drv,
             nix_options=nix_options,
             max_rebuilds=max_rebuilds,
             rebuild_blacklist=rebuild_blacklist,
-        )
-
-        if not drv.can_build_deps():
-            failed = drv.sample_dependency_failure()
-            print(f"Dependency {failed} failed to build.")
-            return f"dependency_failure"
-
-        if drv.can_build():
-            return "success"
-        else:
-            if failure_line is None or drv.log_contains(failure_line):
-                return "failure"
+        ) as drv:
+            if not drv.can_build_deps():
+                failed = drv.sample_dependency_failure()
+                print(f"Dependency {failed} failed to build.")
+                return f"dependency_failure"
+
+            if drv.can_build():
+                return "success"
             else:
-                return "failure_without_line"
+                if failure_line is None or drv.log_contains(failure_line):
+                    return "failure"
+                else:
+                    return "failure_without_line"
     except exceptions.ResourceConstraintException as e:
         print(e)
         return "resource_limit"
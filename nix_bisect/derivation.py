@@ -2,7 +2,9 @@
 as possible."""
 
 from pathlib import Path
+import subprocess
 import time
+import weakref
 
 from nix_bisect import nix, gcroot
 
@@ -14,21 +16,43 @@ class Derivation:
         """Create a new derivation.
 
         The derivation's methods will throw TooManyBuildsException when the
-        rebuild limit is exceeded.
+        rebuild limit is exceeded. The derivation is protected from garbage
+        collection until it is closed, either explicitly or by using it as a
+        context manager.
         """
         self.drv = drv
         self.nix_options = nix_options
         self.max_rebuilds = max_rebuilds if max_rebuilds is not None else float("inf")
-        self.rebuild_blacklist = rebuild_blacklist
-        self._gcroot_name = f"nix-bisect-{Path(drv).name}-{round(time.time() * 1000.0)}"
+        self.rebuild_blacklist = tuple(rebuild_blacklist)
+        self._gcroot_name = f"nix-bisect-{Path(drv).name}-{time.monotonic_ns()}"
         gcroot.create_tmp_gcroot(self._gcroot_name, drv)
+        # Fallback in case the derivation is never closed. Unlike `__del__`,
+        # this also runs at interpreter exit.
+        self._finalizer = weakref.finalize(
+            self, gcroot.delete_tmp_gcroot, self._gcroot_name
+        )
+        # Results of the queries below. Derivations are immutable and their
+        # build results do not change once known, so these never go stale.
+        self._immediate_dependencies = None
+        self._can_build_deps = None
+        self._can_build = None
+        self._log_contains = dict()
+
+    def close(self):
+        """Removes the temporary gcroot of the derivation."""
+        self._finalizer()
 
-    def __del__(self):
-        gcroot.delete_tmp_gcroot(self._gcroot_name)
+    def __enter__(self):
+        return self
+
+    def __exit__(self, _type, _value, _traceback):
+        self.close()
 
     def immediate_dependencies(self):
         """Returns the derivation's immediate dependencies."""
-        return nix.references([self.drv])
+        if self._immediate_dependencies is None:
+            self._immediate_dependencies = nix.references([self.drv])
+        return self._immediate_dependencies
 
     def can_build_deps(self):
         """Determines if the derivation's dependencies build would succeed.
@@ -36,12 +60,34 @@ class Derivation:
         This may or may not actually build or fetch the dependencies. If
         possible, cached information is used.
         """
-        return nix.build_would_succeed(
-            self.immediate_dependencies(),
-            nix_options=self.nix_options,
-            max_rebuilds=self.max_rebuilds - 1,
-            rebuild_blacklist=self.rebuild_blacklist,
-        )
+        if self._can_build_deps is None:
+            if self._can_build is None:
+                self._prefetch_dry_runs()
+            self._can_build_deps = nix.build_would_succeed(
+                self.immediate_dependencies(),
+                nix_options=self.nix_options,
+                max_rebuilds=self.max_rebuilds - 1,
+                rebuild_blacklist=self.rebuild_blacklist,
+            )
+        return self._can_build_deps
+
+    def _prefetch_dry_runs(self):
+        """Runs the dry runs of the dependencies and the derivation itself at
+        the same time.
+
+        Both are usually needed. `nix.build_dry` caches the results, and
+        building the dependencies only removes them from the result of the
+        derivation.
+        """
+        try:
+            for _ in nix.build_dry_many(
+                [self.immediate_dependencies(), [self.drv]],
+                nix_options=self.nix_options,
+            ):
+                pass
+        except (subprocess.CalledProcessError, nix.DryRunParseError):
+            # Not cached, so the failure is reported by the actual check.
+            pass
 
     def sample_dependency_failure(self):
         """Returns one dependency failure if it exists.
@@ -63,12 +109,14 @@ class Derivation:
         This may or may not actually build or fetch the derivation. If
         possible, cached information is used.
         """
-        return nix.build_would_succeed(
-            [self.drv],
-            nix_options=self.nix_options,
-            max_rebuilds=self.max_rebuilds,
-            rebuild_blacklist=self.rebuild_blacklist,
-        )
+        if self._can_build is None:
+            self._can_build = nix.build_would_succeed(
+                [self.drv],
+                nix_options=self.nix_options,
+                max_rebuilds=self.max_rebuilds,
+                rebuild_blacklist=self.rebuild_blacklist,
+            )
+        return self._can_build
 
     def log_contains(self, line):
         """Determines if the derivation's build log contains a line.
@@ -76,4 +124,6 @@ class Derivation:
         This may or may not actually build or fetch the derivation. If
         possible, cached information is used.
         """
-        return nix.log_contains(self.drv, line) == "yes"
+        if line not in self._log_contains:
+            self._log_contains[line] = nix.log_contains(self.drv, line) == "yes"
+        return self._log_contains[line]
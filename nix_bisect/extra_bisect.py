@@ -1,8 +1,12 @@
+import os
 import sys
 import argparse
 import subprocess
 import shlex
-from nix_bisect import bisect_runner, git, git_bisect
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from nix_bisect import bisect_env, bisect_runner, git, git_bisect
 
 
 def _setup_start_parser(parser):
@@ -127,6 +131,24 @@ def _setup_env_parser(parser):
 
 
 def _setup_run_parser(parser):
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        type=int,
+        default=1,
+        help="Number of commits to test in parallel, each in its own git worktree",
+    )
+    parser.add_argument(
+        "--worktree-dir",
+        type=str,
+        default=None,
+        help="Where to create the worktrees for --jobs, e.g. a tmpfs like /dev/shm (default: the temporary directory)",
+    )
+    parser.add_argument(
+        "--write-commit-graph",
+        action="store_true",
+        help="Write a commit-graph into the repository first if it has none, which speeds up every step",
+    )
     parser.add_argument(
         "cmd", type=str, help="Command that controls the bisect",
     )
@@ -134,45 +156,149 @@ def _setup_run_parser(parser):
         "args", type=str, nargs=argparse.REMAINDER,
     )
 
+    def _bisect_command(args, patchset):
+        subprocess_args = ["bisect-env"]
+        subprocess_args.extend(bisect_runner.bisect_env_args(patchset))
+        subprocess_args.append(args.cmd)
+        subprocess_args.extend(args.args)
+
+        quoted_cmd = " ".join([shlex.quote(arg) for arg in subprocess_args])
+        bisect_runner.bisect_append_log(f"# $ {quoted_cmd}")
+        print(f"$ {quoted_cmd}")
+        return subprocess_args
+
+    def _is_bad(return_code):
+        return 1 <= return_code <= 127 and return_code not in (125, 129)
+
+    def _contradicts(return_code, commit, good_commits):
+        """Whether a result contradicts the bad mark or commits marked good."""
+        if return_code == 0:
+            return git.is_ancestor("refs/bisect/bad", commit)
+        if _is_bad(return_code):
+            return not git.is_ancestor(commit, "refs/bisect/bad") or any(
+                git.is_ancestor(commit, good) for good in good_commits
+            )
+        return False
+
+    def _record_result(return_code, commit):
+        """Marks a commit according to the return code of the command.
+
+        Returns `False` if the bisect should be aborted."""
+        if return_code == 0:
+            git_bisect.print_good()
+            bisect_runner.bisect_good(commit)
+        elif return_code == 125:
+            git_bisect.print_skip()
+            bisect_runner.bisect_skip(commit)
+        elif return_code == 129:
+            git_bisect.print_skip_range()
+            patchset = bisect_runner.read_patchset()
+            bisect_runner.named_skip("runner-skip", patchset, commit)
+        elif 1 <= return_code <= 127:
+            git_bisect.print_bad()
+            bisect_runner.bisect_bad(commit)
+        else:
+            print(f"Stopping the bisect, the command exited with {return_code}.")
+            return False
+        return True
+
+    def _run_serial(args, runner):
+        while True:
+            patchset = bisect_runner.read_patchset()
+            _bisect_command(args, patchset)
+            # Equivalent to the logged bisect-env command, but without starting
+            # another python interpreter for every step.
+            return_code = bisect_env.run_with_env(
+                lambda: subprocess.call([args.cmd] + args.args),
+                [("try_pick", rev) for rev in patchset],
+            )
+            if not _record_result(return_code, "HEAD"):
+                return False
+            next_commit = runner.get_next()
+            if next_commit is None:
+                return True
+            git.checkout(next_commit)
+
+    def _run_parallel(args, runner):
+        # The command runs inside the worktrees, not in the current directory.
+        if "/" in args.cmd:
+            args.cmd = os.path.abspath(args.cmd)
+        # Like in the serial mode, uncommitted changes and untracked files are
+        # part of what is tested. They are carried over to every worktree.
+        changes = git.snapshot("extra-bisect uncommitted changes")
+        if git.rev_parse(f"{changes}^{{tree}}") == git.rev_parse("HEAD^{tree}"):
+            changes = None
+        # Every job gets its own worktree, which is reused for later rounds.
+        prefix = git.show_prefix()
+        worktrees = []
+        with tempfile.TemporaryDirectory(
+            prefix="extra-bisect-", dir=args.worktree_dir
+        ) as tmpdir:
+            try:
+                with ThreadPoolExecutor(args.jobs) as executor:
+                    while True:
+                        candidates = runner.get_next_candidates(args.jobs)
+                        if len(candidates) == 0:
+                            return True
+                        for (i, commit) in enumerate(candidates):
+                            if i < len(worktrees):
+                                git.worktree_reset(worktrees[i], commit)
+                            else:
+                                worktree = Path(tmpdir).joinpath(str(i))
+                                git.worktree_add(worktree, commit)
+                                worktrees.append(worktree)
+                            if changes is not None and not git.worktree_apply(
+                                worktrees[i], changes
+                            ):
+                                print(
+                                    "Stopping the bisect, the uncommitted changes "
+                                    f"do not apply to {git.rev_pretty(commit)}."
+                                )
+                                return False
+                        subprocess_args = _bisect_command(
+                            args, bisect_runner.read_patchset()
+                        )
+                        return_codes = executor.map(
+                            lambda worktree: subprocess.call(
+                                subprocess_args, cwd=worktree.joinpath(prefix)
+                            ),
+                            worktrees[: len(candidates)],
+                        )
+                        # The candidates are ordered children first, so the
+                        # bad mark moves further back with every bad result.
+                        # Flaky results can contradict each other, the later
+                        # one is dropped so that good never ends up above bad.
+                        good_this_round = []
+                        for (commit, return_code) in zip(candidates, return_codes):
+                            if _contradicts(return_code, commit, good_this_round):
+                                print(
+                                    "Dropped contradicting result for "
+                                    f"{git.rev_pretty(commit)}"
+                                )
+                                continue
+                            print(git.rev_pretty(commit))
+                            if return_code == 0:
+                                good_this_round.append(commit)
+                            if not _record_result(return_code, commit):
+                                return False
+            finally:
+                for worktree in worktrees:
+                    git.worktree_remove(worktree)
+
     def _handle_run(args):
         if not bisect_runner.has_good_and_bad():
             print("You need to mark at least one good and one bad commit first.")
             return 1
 
+        # Every step walks the bisect range, which a commit-graph makes cheap.
+        if args.write_commit_graph:
+            git.ensure_commit_graph()
         runner = bisect_runner.BisectRunner()
-        while True:
-            subprocess_args = ["bisect-env"]
-            subprocess_args.extend(
-                bisect_runner.bisect_env_args(bisect_runner.read_patchset())
-            )
-            subprocess_args.append(args.cmd)
-            subprocess_args.extend(args.args)
-
-            quoted_cmd = " ".join([shlex.quote(arg) for arg in subprocess_args])
-            bisect_runner.bisect_append_log(f"# $ {quoted_cmd}")
-            print(f"$ {quoted_cmd}")
-
-            return_code = subprocess.call(subprocess_args)
-            if return_code == 0:
-                git_bisect.print_good()
-                bisect_runner.bisect_good("HEAD")
-            elif return_code == 125:
-                git_bisect.print_skip()
-                bisect_runner.bisect_skip("HEAD")
-            elif return_code == 129:
-                git_bisect.print_skip_range()
-                patchset = bisect_runner.read_patchset()
-                bisect_runner.named_skip("runner-skip", patchset, "HEAD")
-            elif 1 <= return_code <= 127:
-                git_bisect.print_bad()
-                bisect_runner.bisect_bad("HEAD")
-            else:
-                break
-            next_commit = runner.get_next()
-            if next_commit is None:
-                break
-            git.checkout(next_commit)
-        return 0
+        if args.jobs > 1:
+            finished = _run_parallel(args, runner)
+        else:
+            finished = _run_serial(args, runner)
+        return 0 if finished else 1
 
     parser.set_defaults(func=_handle_run)
 
@@ -210,10 +336,14 @@ def _main():
     _setup_start_parser(subparsers.add_parser("start"))
     _setup_reset_parser(subparsers.add_parser("reset"))
 
-    args = parser.parse_args()
-    if not hasattr(args, "func"):
+    def _handle_missing_subcommand(_args):
         parser.print_usage()
         return 128
+
+    # Overridden by the subparsers' own defaults.
+    parser.set_defaults(func=_handle_missing_subcommand)
+
+    args = parser.parse_args()
     return args.func(args)
 
 
@@ -1,44 +1,78 @@
 """Utilities for interacting with git."""
 
+import fnmatch
+import functools
+import itertools
+import os
 import subprocess
-from subprocess import run, PIPE
-from math import log, floor, ceil
+from subprocess import run, PIPE, DEVNULL
+from pathlib import Path
+import shlex
+import shutil
 import signal
+import sys
+import tempfile
+import threading
+
+# We call git a lot. Resolving it once and passing `close_fds=False` enables
+# subprocess to use `posix_spawn` instead of `fork`, which is much cheaper for
+# a large parent process. Our own file descriptors are not inheritable anyway.
+_GIT = shutil.which("git") or "git"
+
+# Bumped whenever refs are changed through this module, so that callers can
+# cache results that depend on refs.
+_ref_generation = 0
 
 
 def cur_commit():
     """Returns the rev of the current HEAD."""
-    result = run(
-        ["git", "rev-parse", "HEAD"], stdout=PIPE, stderr=PIPE, encoding="utf-8",
-    )
-    result.check_returncode()
-    return result.stdout.strip()
+    return rev_parse("HEAD")
 
 
 def commits_in_range(rev1, rev2):
     """Returns all commits withing a range"""
+    try:
+        return list(_commits_in_range(rev_parse(rev1), rev_parse(rev2)))
+    except subprocess.CalledProcessError:
+        return []
+
+
+# The history reachable from full hashes never changes, so queries that only
+# depend on full hashes can be cached for the lifetime of the process.
+@functools.lru_cache(maxsize=256)
+def _commits_in_range(commit1, commit2):
     result = run(
-        ["git", "log", "--pretty=format:%H", f"{rev1}..{rev2}"],
+        [_GIT, "log", "--pretty=format:%H", f"{commit1}..{commit2}"],
         stdout=PIPE,
         stderr=PIPE,
         encoding="utf-8",
+        close_fds=False,
     )
-    return result.stdout.splitlines()
+    return tuple(result.stdout.splitlines())
 
 
 def bisect_revisions():
     """Returns the amount of still possible first-bad commits.
     
     This is an approximation."""
-    result = run(
-        ["git", "bisect", "visualize", "--oneline"],
-        stdout=PIPE,
-        stderr=PIPE,
-        encoding="utf-8",
-    )
-    result.check_returncode()
-    lines = result.stdout.splitlines()
-    interesting = [line for line in lines if "refs/bisect/skip" not in line]
+    # Same range as `git bisect visualize`, but without formatting a log.
+    resolved_refs = get_resolved_refs_with_prefix("refs/bisect")
+    good_refs = [
+        ref for (_commit, ref) in resolved_refs if ref.startswith("refs/bisect/good-")
+    ]
+    skipped = {
+        commit
+        for (commit, ref) in resolved_refs
+        if ref.startswith("refs/bisect/skip-")
+    }
+    names_file = Path(git_dir()).joinpath("BISECT_NAMES")
+    paths = shlex.split(names_file.read_text()) if names_file.exists() else []
+    candidates = subprocess.check_output(
+        [_GIT, "rev-list", "refs/bisect/bad", "--not"] + good_refs + ["--"] + paths,
+        close_fds=False,
+        text=True,
+    ).splitlines()
+    interesting = [commit for commit in candidates if commit not in skipped]
     # the earliest known bad commit will be included in the bisect view
     return len(interesting) - 1
 
@@ -47,25 +81,39 @@ def bisect_steps_remaining():
     """Estimate of remaining steps, including the current one.
 
     This is an approximation."""
+    return _steps_remaining(bisect_revisions())
+
+
+def _steps_remaining(revisions):
     # https://github.com/git/git/blob/566a1439f6f56c2171b8853ddbca0ad3f5098770/bisect.c#L1043
-    return floor(log(bisect_revisions(), 2))
+    # floor(log2(revisions)), without going through floats
+    return revisions.bit_length() - 1
 
 
 def bisect_status():
     """Reproduce the status line git-bisect prints after each step."""
+    revisions = bisect_revisions()
+    # `revisions >> 1` is ceil((revisions - 1) / 2)
     return "Bisecting: {} revisions left to test after this (roughly {} steps).".format(
-        ceil((bisect_revisions() - 1) / 2), bisect_steps_remaining() - 1,
+        revisions >> 1, _steps_remaining(revisions) - 1,
     )
 
 
 class assure_nothing_unstaged:
-    """Context that temporarily commits staged changes."""
+    """Context that temporarily stages all changes.
+
+    `git cherry-pick -n` and `git revert -n` start from the index, so this is
+    enough to apply them on top of uncommitted changes. Entering returns the
+    tree of the staged state, which `restore_tree` can go back to. The index is
+    reset to HEAD when the context is left.
+    """
 
     def __enter__(self):
         self.head_before = cur_commit()
         add(".")
-        commit(f"TMP clean slate")
-        return None
+        return subprocess.check_output(
+            [_GIT, "write-tree"], close_fds=False, text=True
+        ).strip()
 
     def __exit__(self, type, value, traceback):
         s = signal.signal(signal.SIGINT, signal.SIG_IGN)
@@ -73,6 +121,62 @@ class assure_nothing_unstaged:
         signal.signal(signal.SIGINT, s)
 
 
+def restore_tree(tree):
+    """Makes the index and the working tree match `tree` again.
+
+    Files that are not tracked in either are left alone, like with a hard reset.
+    """
+    result = run(
+        [_GIT, "read-tree", "--reset", "-u", tree],
+        stdout=DEVNULL,
+        stderr=PIPE,
+        close_fds=False,
+    )
+    result.check_returncode()
+
+
+@functools.lru_cache(maxsize=1)
+def _index_path():
+    return (
+        subprocess.check_output(
+            [_GIT, "rev-parse", "--git-path", "index"], close_fds=False
+        )
+        .decode()
+        .strip()
+    )
+
+
+def snapshot(message):
+    """Commits the state of the working tree on top of HEAD.
+
+    Neither HEAD nor the index are changed. Untracked (but not ignored) files
+    are included. Returns the hash of the new commit.
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # Work on a copy of the index, so that only changed files have to be
+        # hashed.
+        index_file = Path(tmp_dir).joinpath("index")
+        if Path(_index_path()).exists():
+            shutil.copyfile(_index_path(), index_file)
+        env = dict(os.environ, GIT_INDEX_FILE=str(index_file))
+        result = run(
+            [_GIT, "add", "."],
+            stdout=DEVNULL,
+            stderr=PIPE,
+            env=env,
+            close_fds=False,
+        )
+        result.check_returncode()
+        tree = subprocess.check_output(
+            [_GIT, "write-tree"], env=env, close_fds=False, text=True
+        ).strip()
+    return subprocess.check_output(
+        [_GIT, "commit-tree", tree, "-p", "HEAD", "-m", message],
+        close_fds=False,
+        text=True,
+    ).strip()
+
+
 # FIXME create a worktree, periodically re-sync with original
 class git_checkpoint:
     """Context that remembers the repository's state
@@ -85,12 +189,7 @@ class git_checkpoint:
         self.head_before = cur_commit()
 
         # Create a commit that reflects the current state of the repo.
-        add(".")
-        commit(f"TMP clean slate")
-        self.checkpint_rev = cur_commit()
-
-        # Return to the original commit (soft reset).
-        reset(self.head_before)
+        self.checkpint_rev = snapshot(f"TMP clean slate")
         return None
 
     def __exit__(self, type, value, traceback):
@@ -105,11 +204,64 @@ class git_checkpoint:
 
 def parents(rev):
     """Returns all parent revisions of a revision"""
+    return list(_parents(rev_parse(rev)))
+
+
+# Commits are immutable, so everything that only depends on a full hash can be
+# cached for the lifetime of the process.
+@functools.lru_cache(maxsize=4096)
+def _parents(commit):
+    if _is_shallow():
+        # Commits at the shallow boundary name parents that are not present,
+        # let git hide them.
+        return tuple(
+            subprocess.check_output(
+                [_GIT, "rev-list", "-n", "1", "--parents", commit], close_fds=False
+            )
+            .decode()
+            .strip()
+            .split(" ")[1:]
+        )
+    return _read_commit(commit)[0]
+
+
+@functools.lru_cache(maxsize=4096)
+def _read_commit(commit):
+    """Returns the parents and the subject of a commit.
+
+    The commit object is read through the long-running `git cat-file --batch`
+    process.
+    """
+    content = _batch.read(f"{commit}^{{commit}}")
+    if content is None:
+        raise subprocess.CalledProcessError(128, ["git", "cat-file", "--batch"])
+    (header, _sep, message) = content.decode("utf-8", "replace").partition("\n\n")
+    commit_parents = tuple(
+        line[len("parent ") :]
+        for line in header.splitlines()
+        if line.startswith("parent ")
+    )
+    # Like `--pretty=format:%s`, the subject is the first paragraph of the
+    # message joined into a single line.
+    subject_lines = []
+    for line in message.splitlines():
+        if line.strip() == "":
+            if len(subject_lines) > 0:
+                break
+            continue
+        subject_lines.append(line.rstrip())
+    return (commit_parents, " ".join(subject_lines).strip())
+
+
+@functools.lru_cache(maxsize=1)
+def _is_shallow():
     return (
-        subprocess.check_output(["git", "rev-list", "-n", "1", "--parents", rev])
+        subprocess.check_output(
+            [_GIT, "rev-parse", "--is-shallow-repository"], close_fds=False
+        )
         .decode()
         .strip()
-        .split(" ")[1:]
+        == "true"
     )
 
 
@@ -122,20 +274,73 @@ def try_cherry_pick_all(rev):
     return any_success
 
 
+def _first_error_line(stderr):
+    """Extracts the message of the first line of git's stderr output."""
+    first_line = stderr.split(b"\n", 1)[0]
+    return first_line.decode("utf-8", "replace")[len("error: ") - 1 :]
+
+
+def try_cherry_pick_batch(revs):
+    """Tries to cherry pick a list of revisions in a single git call.
+
+    Returns `True` if all of them applied cleanly. Otherwise the working tree
+    is left untouched and `False` is returned, so that the caller can fall
+    back to picking them one by one.
+    """
+    with assure_nothing_unstaged() as clean_slate:
+        result = run(
+            [_GIT, "cherry-pick", "-n"] + list(revs),
+            stdout=DEVNULL,
+            stderr=DEVNULL,
+            close_fds=False,
+        )
+
+        if result.returncode != 0:
+            # Forget the sequencer state of the partially applied picks.
+            run(
+                [_GIT, "cherry-pick", "--quit"],
+                stdout=DEVNULL,
+                stderr=DEVNULL,
+                close_fds=False,
+            )
+            restore_tree(clean_slate)
+            return False
+
+        for rev in revs:
+            print(f"Cherry-pick of {rev} succeeded")
+        return True
+
+
+def try_cherry_pick_all_batched(revs):
+    """Tries to cherry pick a list of revisions, yielding `(rev, success)`.
+
+    Usually all of them apply, which is checked with a single cherry-pick.
+    Only if that fails they are picked one by one with `try_cherry_pick_all`.
+    The caller may stop iterating to leave the remaining revisions unpicked.
+    """
+    revs = list(revs)
+    if len(revs) > 1 and try_cherry_pick_batch(revs):
+        for rev in revs:
+            yield (rev, True)
+        return
+    for rev in revs:
+        yield (rev, try_cherry_pick_all(rev))
+
+
 def try_cherry_pick(rev, mainline=1):
     rev_name = rev + ("" if mainline == 1 else f"(mainline {mainline})")
-    with assure_nothing_unstaged():
+    with assure_nothing_unstaged() as clean_slate:
         result = run(
-            ["git", "cherry-pick", "--mainline", str(mainline), "-n", rev],
-            stdout=PIPE,
+            [_GIT, "cherry-pick", "--mainline", str(mainline), "-n", rev],
+            stdout=DEVNULL,
             stderr=PIPE,
-            encoding="utf-8",
+            close_fds=False,
         )
 
         if result.returncode != 0:
             print(f"Cherry-pick of {rev_name} failed")
-            print(result.stderr.splitlines()[0][len("error: ") - 1 :])
-            reset("HEAD", extra_flags=["--hard"])
+            print(_first_error_line(result.stderr))
+            restore_tree(clean_slate)
             return False
 
         print(f"Cherry-pick of {rev_name} succeeded")
@@ -143,15 +348,18 @@ def try_cherry_pick(rev, mainline=1):
 
 
 def try_revert(rev):
-    with assure_nothing_unstaged():
+    with assure_nothing_unstaged() as clean_slate:
         result = run(
-            ["git", "revert", "-n", rev], stdout=PIPE, stderr=PIPE, encoding="utf-8",
+            [_GIT, "revert", "-n", rev],
+            stdout=DEVNULL,
+            stderr=PIPE,
+            close_fds=False,
         )
 
         if result.returncode != 0:
             print("Revert failed")
-            print(result.stderr.splitlines()[0][len("error: ") - 1 :])
-            reset("HEAD", extra_flags=["--hard"])
+            print(_first_error_line(result.stderr))
+            restore_tree(clean_slate)
             return False
 
         print("Revert succeeded")
@@ -161,7 +369,18 @@ def try_revert(rev):
 def is_ancestor(ancestor, parent):
     """Returns `True` iff `ancestor` is an ancestor of `parent`."""
     try:
-        subprocess.check_call(["git", "merge-base", "--is-ancestor", ancestor, parent],)
+        return _is_ancestor_resolved(rev_parse(ancestor), rev_parse(parent))
+    except subprocess.CalledProcessError:
+        return False
+
+
+@functools.lru_cache(maxsize=4096)
+def _is_ancestor_resolved(ancestor, parent):
+    # Full hashes are immutable, so the answer can be cached forever.
+    try:
+        subprocess.check_call(
+            [_GIT, "merge-base", "--is-ancestor", ancestor, parent], close_fds=False,
+        )
         return True
     except subprocess.CalledProcessError:
         return False
@@ -169,39 +388,122 @@ def is_ancestor(ancestor, parent):
 
 def reset(rev, extra_flags=[]):
     result = run(
-        ["git", "reset"] + extra_flags + [rev],
-        stdout=PIPE,
+        [_GIT, "reset"] + extra_flags + [rev],
+        stdout=DEVNULL,
         stderr=PIPE,
-        encoding="utf-8",
+        close_fds=False,
     )
     result.check_returncode()
 
 
 def clean(extra_flags=[]):
     result = run(
-        ["git", "clean"] + extra_flags, stdout=PIPE, stderr=PIPE, encoding="utf-8",
+        [_GIT, "clean"] + extra_flags,
+        stdout=DEVNULL,
+        stderr=PIPE,
+        close_fds=False,
     )
     result.check_returncode()
 
 
 def add(path):
-    result = run(["git", "add", path], stdout=PIPE, stderr=PIPE, encoding="utf-8",)
-    result.check_returncode()
-
-
-def commit(message):
     result = run(
-        ["git", "commit", "--allow-empty", "-m", message],
-        stdout=PIPE,
+        [_GIT, "add", path],
+        stdout=DEVNULL,
         stderr=PIPE,
-        encoding="utf-8",
+        close_fds=False,
     )
     result.check_returncode()
 
 
 def checkout(commit):
     """Runs `git checkout`"""
-    subprocess.check_call(["git", "checkout", commit])
+    subprocess.check_call([_GIT, "checkout", commit], close_fds=False)
+
+
+def worktree_add(path, commit):
+    """Creates a new worktree at `path` with `commit` checked out (detached)."""
+    subprocess.check_call(
+        [_GIT, "worktree", "add", "--quiet", "--detach", str(path), commit],
+        close_fds=False,
+    )
+
+
+def worktree_reset(path, commit):
+    """Checks out `commit` in the worktree at `path`, discarding everything
+    that was changed or added there."""
+    subprocess.check_call(
+        [_GIT, "-C", str(path), "checkout", "--quiet", "--force", "--detach", commit],
+        close_fds=False,
+    )
+    subprocess.check_call(
+        [_GIT, "-C", str(path), "clean", "--quiet", "--force", "-d"],
+        close_fds=False,
+    )
+
+
+def worktree_apply(path, rev):
+    """Applies the changes of `rev` to the worktree at `path` without
+    committing them. Returns `False` if they do not apply."""
+    result = run(
+        [_GIT, "-C", str(path), "cherry-pick", "--no-commit", rev],
+        stdout=DEVNULL,
+        stderr=PIPE,
+        close_fds=False,
+    )
+    if result.returncode != 0:
+        print(_first_error_line(result.stderr))
+        return False
+    return True
+
+
+def worktree_remove(path):
+    """Removes a worktree created by `worktree_add`, even if it is dirty."""
+    subprocess.check_call(
+        [_GIT, "worktree", "remove", "--force", str(path)], close_fds=False
+    )
+
+
+def show_prefix():
+    """Returns the path of the current directory relative to the worktree root"""
+    return subprocess.check_output(
+        [_GIT, "rev-parse", "--show-prefix"], close_fds=False, text=True
+    ).strip()
+
+
+def _read_bisect_refs(prefix):
+    """Lists the refs below a `refs/bisect` prefix by reading the ref files.
+
+    Bisect refs are per-worktree refs, which git never packs. Unless the
+    repository uses the reftable backend, they are all loose files in the git
+    dir and can be listed without starting `git for-each-ref`. Returns a list
+    of `(commit, ref)` pairs sorted by ref, or `None` if git has to be asked.
+    """
+    if prefix != "refs/bisect" and not prefix.startswith("refs/bisect/"):
+        return None
+    root = Path(git_dir())
+    if root.joinpath("reftable").exists():
+        return None
+    base = root.joinpath(prefix)
+    paths = [base] if base.is_file() else base.rglob("*")
+    resolved = []
+    for path in paths:
+        if path.name.endswith(".lock") or not path.is_file():
+            continue
+        try:
+            commit = path.read_text().strip()
+        except FileNotFoundError:
+            # Deleted while listing
+            continue
+        if len(commit) not in (40, 64) or not all(c in _HEX_DIGITS for c in commit):
+            # e.g. a symbolic ref, leave those to git
+            return None
+        resolved.append((commit, path.relative_to(root).as_posix()))
+    resolved.sort(key=lambda pair: pair[1])
+    return resolved
+
+
+_HEX_DIGITS = frozenset("0123456789abcdef")
 
 
 def get_refs_with_prefix(prefix):
@@ -210,20 +512,150 @@ def get_refs_with_prefix(prefix):
     Internally calls `git for-each-ref`. The prefix has to be complete up to a
     `/`, i.e. `some/pre` will find `some/pre/asdf` but not some/prefix.
     """
-    return (
-        subprocess.check_output(["git", "for-each-ref", "--format=%(refname)", prefix],)
-        .decode()
-        .splitlines()
+    resolved = _read_bisect_refs(prefix)
+    if resolved is not None:
+        return [ref for (_commit, ref) in resolved]
+    return subprocess.check_output(
+        [_GIT, "for-each-ref", "--format=%(refname)", prefix],
+        close_fds=False,
+        text=True,
+    ).splitlines()
+
+
+def get_refs_matching(pattern):
+    """Returns a list of refs that match a glob pattern.
+
+    The pattern is matched by `git for-each-ref` itself, so that refs that are
+    not of interest are never listed. As in git, `*` does not match `/`.
+    """
+    components = pattern.split("/")
+    literal = list(itertools.takewhile(lambda c: not _has_glob(c), components))
+    resolved = _read_bisect_refs("/".join(literal))
+    if resolved is not None:
+        if len(literal) == len(components):
+            # Without any globs, the pattern is a prefix.
+            return [ref for (_commit, ref) in resolved]
+        return [
+            ref
+            for (_commit, ref) in resolved
+            if _matches_components(ref.split("/"), components)
+        ]
+    return subprocess.check_output(
+        [_GIT, "for-each-ref", "--format=%(refname)", pattern],
+        close_fds=False,
+        text=True,
+    ).splitlines()
+
+
+def _has_glob(component):
+    return any(c in component for c in "*?[")
+
+
+def _matches_components(ref_components, pattern_components):
+    return len(ref_components) == len(pattern_components) and all(
+        fnmatch.fnmatchcase(ref_component, pattern_component)
+        for (ref_component, pattern_component) in zip(
+            ref_components, pattern_components
+        )
     )
 
 
+def get_resolved_refs_with_prefix(prefix):
+    """Returns a list of `(commit, ref)` pairs for refs that start with a prefix.
+
+    Like `get_refs_with_prefix`, but also resolves the refs in the same call
+    to `git for-each-ref`.
+    """
+    resolved = _read_bisect_refs(prefix)
+    if resolved is not None:
+        return resolved
+    output = subprocess.check_output(
+        [_GIT, "for-each-ref", "--format=%(objectname)\t%(refname)", prefix],
+        close_fds=False,
+        text=True,
+    )
+    resolved = []
+    for line in output.splitlines():
+        (commit, _tab, ref) = line.partition("\t")
+        resolved.append((commit, ref))
+    return resolved
+
+
+def refs_containing(commit, refs):
+    """Returns the subset of `refs` that have `commit` as an ancestor.
+
+    Internally calls `git for-each-ref --contains`, which checks all refs in
+    one reachability walk.
+    """
+    if len(refs) == 0:
+        return []
+    return subprocess.check_output(
+        [_GIT, "for-each-ref", "--format=%(refname)", f"--contains={commit}"]
+        + list(refs),
+        close_fds=False,
+        text=True,
+    ).splitlines()
+
+
+def refs_merged_into(commit, refs):
+    """Returns the subset of `refs` that are ancestors of `commit`.
+
+    Internally calls `git for-each-ref --merged`.
+    """
+    if len(refs) == 0:
+        return []
+    return subprocess.check_output(
+        [_GIT, "for-each-ref", "--format=%(refname)", f"--merged={commit}"]
+        + list(refs),
+        close_fds=False,
+        text=True,
+    ).splitlines()
+
+
+def get_refs_pointing_at(commit, prefix=None):
+    """Returns a list of refs that point to `commit`.
+
+    Internally calls `git for-each-ref --points-at`. If `prefix` is given, only
+    refs starting with it are returned (see `get_refs_with_prefix`).
+    """
+    patterns = [prefix] if prefix is not None else []
+    return subprocess.check_output(
+        [_GIT, "for-each-ref", "--format=%(refname)", f"--points-at={commit}"]
+        + patterns,
+        close_fds=False,
+        text=True,
+    ).splitlines()
+
+
 def rev_list(include, exclude):
     """Find all revs that are reachable by `include` but not by `exclude`.
 
     Runs `git rev-list` internally.
     """
     args = include + ["--not"] + [exclude]
-    return subprocess.check_output(["git", "rev-list"] + args).decode().splitlines()
+    return subprocess.check_output(
+        [_GIT, "rev-list"] + args, close_fds=False, text=True
+    ).splitlines()
+
+
+def bisect_range_commits(bad_commit, good_commits):
+    """Returns the commits reachable from `bad_commit` but not from any of the
+    `good_commits`, children before their parents."""
+    return list(
+        _bisect_range_commits(rev_parse(bad_commit), _rev_parse_all(good_commits))
+    )
+
+
+@functools.lru_cache(maxsize=256)
+def _bisect_range_commits(bad_commit, good_commits):
+    return tuple(
+        subprocess.check_output(
+            [_GIT, "rev-list", "--topo-order", bad_commit, "--not"]
+            + list(good_commits),
+            close_fds=False,
+            text=True,
+        ).splitlines()
+    )
 
 
 def get_bisect_info(good_commits, bad_commit):
@@ -239,11 +671,9 @@ def get_bisect_info(good_commits, bad_commit):
     - biset_step: estimated steps after bisect_rev
     """
     args = [bad_commit] + [f"^{commit}" for commit in good_commits]
-    lines = (
-        subprocess.check_output(["git", "rev-list", "--bisect-vars"] + args)
-        .decode()
-        .splitlines()
-    )
+    lines = subprocess.check_output(
+        [_GIT, "rev-list", "--bisect-vars"] + args, close_fds=False, text=True
+    ).splitlines()
     key_values = [line.split("=") for line in lines]
     info = dict(key_values)
     # this is a quoted string; strip the quotes
@@ -258,52 +688,242 @@ def get_bisect_all(good_commits, bad_commit):
 
     Internally runs `git rev-list --bisect-all`.
     """
+    return list(_get_bisect_all(_rev_parse_all(good_commits), rev_parse(bad_commit)))
+
+
+@functools.lru_cache(maxsize=256)
+def _get_bisect_all(good_commits, bad_commit):
     # Could also be combined with --bisect-vars, that may be more efficient.
     args = [bad_commit] + [f"^{commit}" for commit in good_commits]
-    lines = (
-        subprocess.check_output(["git", "rev-list", "--bisect-all"] + args)
-        .decode()
-        .splitlines()
-    )
+    lines = subprocess.check_output(
+        [_GIT, "rev-list", "--bisect-all"] + args, close_fds=False, text=True
+    ).splitlines()
     # first is furthest away, last is equal to bad
-    commits = [line.split(" ")[0] for line in lines]
-    return commits
+    return tuple(line.split(" ")[0] for line in lines)
+
+
+class _CatFile:
+    """A long-running `git cat-file` process in one of its batch modes.
+
+    Objects are queried by writing their names to its stdin and reading the
+    answer back, which is much cheaper than starting a new git process for
+    every query.
+    """
+
+    def __init__(self, mode):
+        self._mode = mode
+        self._process = None
+        self._lock = threading.Lock()
+
+    def _query(self, rev):
+        # Has to be called with the lock held.
+        if self._process is None:
+            self._process = subprocess.Popen(
+                [_GIT, "cat-file", self._mode],
+                stdin=PIPE,
+                stdout=PIPE,
+                close_fds=False,
+            )
+        try:
+            self._process.stdin.write(f"{rev}\n".encode())
+            self._process.stdin.flush()
+            line = self._process.stdout.readline()
+        except BrokenPipeError:
+            line = b""
+        if line == b"":
+            # The process died. Report it and start a new one next time.
+            returncode = self._process.wait()
+            self._process = None
+            raise subprocess.CalledProcessError(
+                returncode, ["git", "cat-file", self._mode]
+            )
+        line = line.decode().strip()
+        # Failures are reported as "<rev> missing" or "<rev> ambiguous".
+        if line.endswith(" missing") or line.endswith(" ambiguous"):
+            return None
+        return line
+
+    def resolve(self, rev):
+        """Returns the full hash of `rev` or `None` if it does not exist.
+
+        Only works in `--batch-check=%(objectname)` mode.
+        """
+        with self._lock:
+            return self._query(rev)
+
+    def read(self, rev):
+        """Returns the content of `rev` or `None` if it does not exist.
+
+        Only works in `--batch` mode.
+        """
+        with self._lock:
+            header = self._query(rev)
+            if header is None:
+                return None
+            size = int(header.rsplit(" ", 1)[1])
+            content = self._process.stdout.read(size)
+            # The content is followed by a newline.
+            self._process.stdout.read(1)
+        return content
+
+
+_batch_check = _CatFile("--batch-check=%(objectname)")
+_batch = _CatFile("--batch")
+
+
+def _update_ref_once(command):
+    """Runs a single `update` or `delete` command in a new git process."""
+    run(
+        [_GIT, "update-ref", "--stdin"],
+        input=f"{command}\n".encode(),
+        check=True,
+        close_fds=False,
+    )
+
+
+class _RefUpdater:
+    """A long-running `git update-ref --stdin` process.
+
+    Every command is sent as its own transaction, so it is applied as soon as
+    git acknowledges the commit of that transaction. Transactions need git
+    2.27 or newer, older versions get a new process for every command.
+    """
+
+    def __init__(self):
+        self._process = None
+        self._transactions = True
+        self._lock = threading.Lock()
+
+    def run(self, command):
+        """Runs a single `update` or `delete` command."""
+        with self._lock:
+            if not self._transactions:
+                _update_ref_once(command)
+                return
+            if self._process is None:
+                self._process = subprocess.Popen(
+                    [_GIT, "update-ref", "--stdin"],
+                    stdin=PIPE,
+                    stdout=PIPE,
+                    stderr=PIPE,
+                    close_fds=False,
+                )
+            self._process.stdin.write(f"start\n{command}\ncommit\n".encode())
+            self._process.stdin.flush()
+            replies = [self._process.stdout.readline() for _ in range(2)]
+            if replies != [b"start: ok\n", b"commit: ok\n"]:
+                # git has exited, the reason is on stderr.
+                (_, stderr) = self._process.communicate()
+                returncode = self._process.returncode
+                self._process = None
+                if replies[0] == b"" and b"unknown command" in stderr:
+                    # Too old to know about transactions.
+                    self._transactions = False
+                    _update_ref_once(command)
+                    return
+                sys.stderr.buffer.write(stderr)
+                sys.stderr.buffer.flush()
+                raise subprocess.CalledProcessError(
+                    returncode, ["git", "update-ref", "--stdin"]
+                )
+
+
+_ref_updater = _RefUpdater()
 
 
 def rev_parse(commit_ish, short=False):
     """Parses a "commit_ish" to a unique full hash"""
-    args = ["--short"] if short else []
+    if not short:
+        result = _batch_check.resolve(commit_ish)
+        if result is None:
+            raise subprocess.CalledProcessError(
+                128, ["git", "cat-file", "--batch-check"]
+            )
+        return result
     return (
-        subprocess.check_output(["git", "rev-parse"] + args + [commit_ish])
+        subprocess.check_output(
+            [_GIT, "rev-parse", "--short", commit_ish], close_fds=False
+        )
         .decode()
         .strip()
     )
 
 
+def _rev_parse_all(revs):
+    """Resolves a list of revisions to a tuple of full hashes, keeping the order."""
+    return tuple(rev_parse(rev) for rev in revs)
+
+
+def ref_generation():
+    """Returns a counter that changes whenever refs are updated or deleted."""
+    return _ref_generation
+
+
 def update_ref(ref, value):
     """Updates or creates a reference."""
-    subprocess.check_call(["git", "update-ref", ref, value])
+    global _ref_generation
+    _ref_generation += 1
+    _ref_updater.run(f"update {ref} {value}")
 
 
 def delete_ref(ref):
     """Deletes a reference."""
-    subprocess.check_call(["git", "update-ref", "-d", ref])
+    global _ref_generation
+    _ref_generation += 1
+    _ref_updater.run(f"delete {ref}")
 
 
-def git_dir():
-    """Returns the path to the .git directory (works with worktrees)"""
-    return subprocess.check_output(["git", "rev-parse", "--git-dir"]).decode().strip()
+def ensure_commit_graph():
+    """Writes a commit-graph file if the repository does not have one yet.
+
+    The commit-graph stores the parents and generation numbers of all commits,
+    which lets git answer the range and ancestry queries of a bisect without
+    parsing every commit object along the way. Returns `False` if it could not
+    be written, the bisect works without one.
+    """
+    paths = subprocess.check_output(
+        [
+            _GIT,
+            "rev-parse",
+            "--git-path",
+            "objects/info/commit-graph",
+            "--git-path",
+            "objects/info/commit-graphs",
+        ],
+        close_fds=False,
+        text=True,
+    ).splitlines()
+    if any(Path(path).exists() for path in paths):
+        return True
+    print("Writing a commit-graph, this may take a while on large repositories.")
+    result = run(
+        [_GIT, "commit-graph", "write", "--reachable", "--no-progress"],
+        stdout=DEVNULL,
+        stderr=PIPE,
+        close_fds=False,
+    )
+    if result.returncode != 0:
+        print("Writing the commit-graph failed, continuing without it.")
+        print(_first_error_line(result.stderr))
+        return False
+    return True
 
 
-def commit_msg(rev):
-    """Returns the short commit message summary (the first line)"""
+@functools.lru_cache(maxsize=1)
+def git_dir():
+    """Returns the path to the .git directory (works with worktrees)"""
     return (
-        subprocess.check_output(["git", "show", "--pretty=format:%s", "-s", rev])
+        subprocess.check_output([_GIT, "rev-parse", "--git-dir"], close_fds=False)
         .decode()
         .strip()
     )
 
 
+def commit_msg(rev):
+    """Returns the short commit message summary (the first line)"""
+    return _read_commit(rev_parse(rev))[1]
+
+
 def rev_pretty(rev):
     """Pretty-print a revision for usage in logs."""
     return f"[{rev_parse(rev, short=True)}] {commit_msg(rev)}"
@@ -1,7 +1,8 @@
 """Wrapper for nix functionality"""
 
-from subprocess import run, PIPE
+from subprocess import run, PIPE, DEVNULL
 import subprocess
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 from typing import Set
 
@@ -9,21 +10,72 @@ import struct
 import signal
 import fcntl
 import termios
+import hashlib
 import json
+import mmap
+import os
+import pty
 import re
+import shutil
 import sys
-
-import pexpect
+import tempfile
 
 from appdirs import AppDirs
 
 from nix_bisect import exceptions
 
-# Parse the error output of `nix build`
-_CANNOT_BUILD_PAT = re.compile(b"cannot build derivation '([^']+)': (.+)")
-_BUILD_FAILED_PAT = re.compile(b"build of ('[^']+'(, '[^']+')*) failed")
-_BUILDER_FAILED_PAT = re.compile(b"builder for '([^']+)' failed with exit code (\\d+);")
-_BUILD_TIMEOUT_PAT = re.compile(b"building of '([^']+)' timed out after.*")
+# Resolve the executables once instead of searching the PATH on every call.
+_NIX = shutil.which("nix") or "nix"
+_NIX_STORE = shutil.which("nix-store") or "nix-store"
+_NIX_INSTANTIATE = shutil.which("nix-instantiate") or "nix-instantiate"
+
+# Parse the error output of `nix build`. All kinds of failures are matched in a
+# single pass, the name of the matching group tells them apart.
+_FAILURE_PAT = re.compile(
+    b"cannot build derivation '(?P<cannot_build>[^']+)': (?=.)"
+    b"|build of (?P<build_failed>'[^']+'(?:, '[^']+')*) failed"
+    b"|builder for '(?P<builder_failed>[^']+)' failed with exit code \\d+;"
+    b"|building of '(?P<timed_out>[^']+)' timed out after"
+)
+# Every failure line contains one of these. Checking for them is much cheaper
+# than running the pattern above on each line of build output.
+_FAILURE_HINTS = (b"cannot build", b"failed", b"timed out")
+
+# Amount of bytes to read from the build process at once.
+_READ_CHUNK_SIZE = 65536
+
+# Locations of the on-disk caches, only looked up once.
+_CACHE_DIR = Path(AppDirs("nix-bisect").user_cache_dir)
+_LOGS_DIR = _CACHE_DIR.joinpath("logs")
+_LOG_CONTAINS_DIR = _CACHE_DIR.joinpath("log-contains")
+_REFERENCES_DIR = _CACHE_DIR.joinpath("references")
+
+# Cache directories that are known to exist.
+_created_dirs = set()
+
+
+def _ensure_dir(path):
+    """Creates a cache directory, unless that was already done before."""
+    if path not in _created_dirs:
+        path.mkdir(parents=True, exist_ok=True)
+        _created_dirs.add(path)
+
+
+def _write_cache_file(path, content):
+    """Atomically replaces the cache file at `path` with `content`.
+
+    The content is written to a temporary file with a unique name first, so
+    concurrent writers do not trip over each other.
+    """
+    with tempfile.NamedTemporaryFile(
+        "w", dir=path.parent, prefix=f"{path.name}.", suffix=".tmp", delete=False
+    ) as f:
+        f.write(content)
+    try:
+        os.replace(f.name, path)
+    except OSError:
+        os.unlink(f.name)
+        raise
 
 
 def _nix_options_to_flags(nix_options):
@@ -35,41 +87,127 @@ def _nix_options_to_flags(nix_options):
     return option_args
 
 
+# Logs that were already fetched by `log`. A build may replace a log, so this
+# is cleared before every build.
+_log_cache = dict()
+
+
 def log(drv):
     """Returns the build log of a store path."""
-    result = run(["nix", "log", "-f.", drv], stdout=PIPE, stderr=PIPE, encoding="utf-8")
+    if drv in _log_cache:
+        return _log_cache[drv]
+    # A missing log is reported through the return code, the message is of no
+    # interest.
+    result = run(
+        [_NIX, "log", "-f.", drv],
+        stdout=PIPE,
+        stderr=DEVNULL,
+        encoding="utf-8",
+        close_fds=False,
+    )
     if result.returncode != 0:
         return None
+    _log_cache[drv] = result.stdout
     return result.stdout
 
 
+def logs(drvs, max_workers=8):
+    """Returns a dict with the build logs of several store paths.
+
+    Each `nix log` is a separate process, so they are fetched concurrently by
+    up to `max_workers` threads.
+    """
+    drvs = list(drvs)
+    if len(drvs) == 0:
+        return dict()
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(drvs))) as executor:
+        return dict(zip(drvs, executor.map(log, drvs)))
+
+
+# Results of `build_dry`. What still needs to be built changes when something is
+# built, so `build` removes what it realized from them.
+_build_dry_cache = dict()
+
+
+def _build_dry_key(drvs, nix_options):
+    # Options parsed by argparse are lists, which cannot be hashed.
+    return (tuple(drvs), tuple(map(tuple, nix_options)))
+
+
 def build_dry(drvs, nix_options=()):
     """Returns a list of drvs to be built and fetched in order to
     realize `drvs`"""
-    result = run(
-        ["nix-store", "--realize", "--dry-run"]
+    key = _build_dry_key(drvs, nix_options)
+    if key not in _build_dry_cache:
+        _build_dry_cache[key] = _build_dry_uncached(drvs, nix_options)
+    (to_build, to_fetch) = _build_dry_cache[key]
+    return (list(to_build), list(to_fetch))
+
+
+def build_dry_many(drvs_list, nix_options=(), max_workers=None):
+    """Runs `build_dry` for several independent lists of drvs concurrently.
+
+    Yields `(drvs, (to_build, to_fetch))` in the order in which the dry runs
+    finish. All results end up in the `build_dry` cache, even those that are
+    not consumed.
+    """
+    drvs_list = [list(drvs) for drvs in drvs_list]
+    if len(drvs_list) == 0:
+        return
+    if max_workers is None:
+        max_workers = min(len(drvs_list), os.cpu_count() or 1)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(build_dry, drvs, nix_options): drvs for drvs in drvs_list
+        }
+        for future in as_completed(futures):
+            yield (futures[future], future.result())
+
+
+class DryRunParseError(RuntimeError):
+    """Output of a dry run that could not be understood."""
+
+
+def _build_dry_uncached(drvs, nix_options):
+    # The output is parsed while it is produced, dry runs of large closures
+    # list a lot of paths.
+    process = subprocess.Popen(
+        [_NIX_STORE, "--realize", "--dry-run"]
         + _nix_options_to_flags(nix_options)
         + drvs,
-        stdout=PIPE,
+        stdout=subprocess.DEVNULL,
         stderr=PIPE,
         encoding="utf-8",
+        close_fds=False,
     )
-    result.check_returncode()
-    lines = result.stderr.splitlines()
     to_fetch = []
     to_build = []
-    for line in lines:
-        line = line.strip()
-        if "will be fetched" in line:
-            cur = to_fetch
-        elif "will be built" in line:
-            cur = to_build
-        elif line.startswith("/nix/store"):
-            cur += [line]
-        elif line.startswith("warning:"):
-            print(f"dry build: {line}", file=sys.stderr)
-        elif line != "":
-            raise RuntimeError(f"dry-run parsing failed, line was:`{line}`")
+    # Only the lines that are not part of a successful dry run are kept.
+    unparsed_lines = []
+    with process.stderr:
+        for line in process.stderr:
+            line = line.strip()
+            # Most lines are paths, so check for those first.
+            if line.startswith("/nix/store"):
+                cur.append(line)
+            elif "will be fetched" in line:
+                cur = to_fetch
+            elif "will be built" in line:
+                cur = to_build
+            elif line.startswith("warning:"):
+                print(f"dry build: {line}", file=sys.stderr)
+            elif line != "":
+                # Keep reading, a failure of the dry run itself takes
+                # precedence.
+                unparsed_lines.append(line)
+    if process.wait() != 0:
+        raise subprocess.CalledProcessError(
+            process.returncode, process.args, stderr="\n".join(unparsed_lines)
+        )
+    if len(unparsed_lines) > 0:
+        raise DryRunParseError(
+            f"dry-run parsing failed, line was:`{unparsed_lines[0]}`"
+        )
 
     return (to_build, to_fetch)
 
@@ -112,14 +250,14 @@ def instantiate(attrname, nix_file=".", nix_options=(), nix_argstr=(), expressio
             )
         else:
             arg = attrname
-        command = ["nix-instantiate", "-E", arg] + option_args
+        command = [_NIX_INSTANTIATE, "-E", arg] + option_args
     else:
         for name, val in nix_argstr:
             option_args.append("--argstr")
             option_args.append(name)
             option_args.append(val)
-        command = ["nix-instantiate", nix_file, "-A", arg] + option_args
-    result = run(command, stdout=PIPE, stderr=PIPE, encoding="utf-8",)
+        command = [_NIX_INSTANTIATE, nix_file, "-A", arg] + option_args
+    result = run(command, stdout=PIPE, stderr=PIPE, encoding="utf-8", close_fds=False)
 
     if result.returncode == 0:
         return result.stdout.strip()
@@ -131,14 +269,9 @@ def dependencies(drvs, nix_options=()):
     """Returns all dependencies of `drvs` that aren't already in the
     store."""
     (to_build, to_fetch) = build_dry(drvs, nix_options=nix_options)
-    to_realize = to_build + to_fetch
-    for drv in drvs:
-        try:
-            to_realize.remove(drv)
-        except ValueError:
-            # drv already in store
-            pass
-    return to_realize
+    # drvs that are already in the store are not listed in the first place.
+    requested = set(drvs)
+    return [drv for drv in to_build + to_fetch if drv not in requested]
 
 
 class BuildFailure(Exception):
@@ -150,80 +283,115 @@ class BuildFailure(Exception):
         self.drvs_failed = drvs_failed
 
 
+def _failed_drvs_in_line(line):
+    """Returns the drvs a line of `nix build` output blames for a failure.
+
+    Like the line itself, the drvs are `bytes`.
+    """
+    if not any(hint in line for hint in _FAILURE_HINTS):
+        return set()
+
+    drvs_failed = set()
+    for match in _FAILURE_PAT.finditer(line):
+        if match.lastgroup == "build_failed":
+            drvs = match.group("build_failed").split(b", ")
+            drvs_failed.update(drv.strip(b"'") for drv in drvs)  # strip quotes
+        else:
+            drvs_failed.add(match.group(match.lastgroup))
+    return drvs_failed
+
+
+def _read_failed_drvs(master_fd):
+    """Reads the output of `nix build` until EOF, collecting failed drvs.
+
+    The output is passed through to our stdout as it arrives. The drvs are
+    returned as `bytes`.
+    """
+    drvs_failed = set()
+    # We can only reliably use the output for the final error messages, not
+    # for the streamed output of the actual build (since `nix build` skips
+    # lines and trims output). Use `nix.log` for that. Output is read in
+    # chunks and only complete lines are searched for failures.
+    # Extended in place, so that a long line arriving in many chunks is not
+    # copied over and over again.
+    pending = bytearray()
+    while True:
+        try:
+            chunk = os.read(master_fd, _READ_CHUNK_SIZE)
+        except OSError:
+            # Linux reports EIO once the other side of the pty is closed.
+            break
+        if len(chunk) == 0:
+            break
+        sys.stdout.buffer.write(chunk)
+        sys.stdout.buffer.flush()
+        pending += chunk
+        # Everything before the new chunk is known not to contain a line end,
+        # so only search the chunk for the end of the last complete line.
+        end = max(chunk.rfind(b"\n"), chunk.rfind(b"\r"))
+        if end == -1:
+            continue
+        end += len(pending) - len(chunk) + 1
+        for line in pending[:end].splitlines():
+            drvs_failed.update(_failed_drvs_in_line(line))
+        del pending[:end]
+    drvs_failed.update(_failed_drvs_in_line(pending))
+    return drvs_failed
+
+
 def _build_uncached(drvs, nix_options=()):
     if len(drvs) == 0:
         # nothing to do
         return ""
 
-    # We need to use pexpect instead of subprocess.Popen here, since `nix
-    # build` will not produce its regular output when it does not detect a tty.
-    build_process = pexpect.spawn(
-        "nix",
-        ["build", "--no-link"] + _nix_options_to_flags(nix_options) + [d + "^*" if d.endswith(".drv") else d for d in drvs],
-        logfile=sys.stdout.buffer,
-    )
+    # `nix build` will not produce its regular output when it does not detect
+    # a tty, so it runs in its own session with a pty as controlling terminal.
+    (master_fd, slave_fd) = pty.openpty()
+    try:
+        build_process = subprocess.Popen(
+            [_NIX, "build", "--no-link"]
+            + _nix_options_to_flags(nix_options)
+            + [d + "^*" if d.endswith(".drv") else d for d in drvs],
+            stdin=slave_fd,
+            stdout=slave_fd,
+            stderr=slave_fd,
+            start_new_session=True,
+            preexec_fn=lambda: fcntl.ioctl(0, termios.TIOCSCTTY, 0),
+        )
+    finally:
+        os.close(slave_fd)
 
-    # adapted from the pexpect docs
     def _update_build_winsize():
-        s = struct.pack("HHHH", 0, 0, 0, 0)
-        a = struct.unpack(
-            "hhhh", fcntl.ioctl(sys.stdout.fileno(), termios.TIOCGWINSZ, s)
+        size = fcntl.ioctl(
+            sys.stdout.fileno(), termios.TIOCGWINSZ, struct.pack("HHHH", 0, 0, 0, 0)
         )
-        if not build_process.closed:
-            build_process.setwinsize(a[0], a[1])
+        fcntl.ioctl(master_fd, termios.TIOCSWINSZ, size)
 
+    # Only query the terminal size again when it actually changes.
     _update_build_winsize()
-    signal.signal(signal.SIGWINCH, lambda _sig, _data: _update_build_winsize())
-
-    drvs_failed = set()
+    previous_winch_handler = signal.signal(
+        signal.SIGWINCH, lambda _sig, _data: _update_build_winsize()
+    )
     try:
-        while True:
-            # This will fill the "match" instance attribute. Raises on EOF. We
-            # can only reliably use this for the final error output, not for
-            # the streamed output of the actual build (since `nix build` skips
-            # lines and trims output). Use `nix.log` for that.
-            build_process.expect(
-                [
-                    _CANNOT_BUILD_PAT,
-                    _BUILD_FAILED_PAT,
-                    _BUILD_TIMEOUT_PAT,
-                    _BUILDER_FAILED_PAT,
-                ],
-                timeout=None,
-            )
-
-            line = build_process.match.group(0)
-            # Re-match to find out which pattern matched. This doesn't happen very
-            # often, so the wasted effort isn't too bad.
-            # Can't wait for https://www.python.org/dev/peps/pep-0572/
-            match = _CANNOT_BUILD_PAT.match(line)
-            if match is not None:
-                drv = match.group(1).decode()
-                _reason = match.group(2).decode()
-                drvs_failed.add(drv)
-            match = _BUILD_FAILED_PAT.match(line)
-            if match is not None:
-                drv_list = match.group(1).decode()
-                drvs = drv_list.split(", ")
-                drvs = [drv.strip("'") for drv in drvs]  # strip quotes
-                drvs_failed.update(drvs)
-            match = _BUILD_TIMEOUT_PAT.match(line)
-            if match is not None:
-                drv = match.group(1).decode()
-                drvs_failed.add(drv)
-            match = _BUILDER_FAILED_PAT.match(line)
-            if match is not None:
-                drv = match.group(1).decode()
-                _exit_code = match.group(2).decode()
-                drvs_failed.add(drv)
-    except pexpect.exceptions.EOF:
-        pass
+        drvs_failed = _read_failed_drvs(master_fd)
+    finally:
+        signal.signal(signal.SIGWINCH, previous_winch_handler)
+        os.close(master_fd)
+        if build_process.poll() is None:
+            # Interrupted, hang up like a closed terminal would.
+            build_process.send_signal(signal.SIGHUP)
+        build_process.wait()
 
     if len(drvs_failed) > 0:
-        raise BuildFailure(drvs_failed)
+        # Only decode the drvs that actually failed, and each of them once.
+        raise BuildFailure({drv.decode() for drv in drvs_failed})
 
     location_process = run(
-        ["nix-store", "--realize"] + drvs, stdout=PIPE, stderr=PIPE, encoding="utf-8",
+        [_NIX_STORE, "--realize"] + drvs,
+        stdout=PIPE,
+        stderr=PIPE,
+        encoding="utf-8",
+        close_fds=False,
     )
     location_process.check_returncode()
     storepaths = location_process.stdout.split("\n")
@@ -235,16 +403,38 @@ def log_contains(drv, phrase, write_cache=True):
 
     This may or may not cause a rebuild. Cached logs are only trusted if they
     were produced by nix-bisect. May return "yes", "no_fail" or "no_success".
+    Previous answers are only reused when `write_cache` is set.
     """
-    cache_dir = Path(AppDirs("nix-bisect").user_cache_dir)
-
+    key = hashlib.sha256(f"{drv}\0{phrase}".encode()).hexdigest()
+    cache_file = _LOG_CONTAINS_DIR.joinpath(key)
+    if write_cache and cache_file.exists():
+        return cache_file.read_text()
+
+    result = _log_contains_uncached(drv, phrase, write_cache)
+    # A failure without the phrase is not final, it is checked again next
+    # time.
+    if write_cache and result in ("yes", "no_success"):
+        _ensure_dir(_LOG_CONTAINS_DIR)
+        _write_cache_file(cache_file, result)
+    return result
+
+
+def _file_contains(path, needle):
+    """Checks if a file contains `needle`, without reading it into memory."""
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            # Empty files cannot be mapped.
+            return len(needle) == 0
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as content:
+            return content.find(needle) != -1
+
+
+def _log_contains_uncached(drv, phrase, write_cache):
     # If we already tried this before, we can trust our own cache.
-    logfile = cache_dir.joinpath("logs").joinpath(Path(drv).name)
+    logfile = _LOGS_DIR.joinpath(drv.rpartition("/")[2])
     if logfile.exists():
-        with open(logfile, "r") as f:
-            log_content = f.read()
-            # We only save logs of failures.
-            return "yes" if phrase in log_content else "no_fail"
+        # We only save logs of failures.
+        return "yes" if _file_contains(logfile, phrase.encode()) else "no_fail"
 
     # We have to be careful with nix's cache since it might be incomplete.
     log_content = log(drv)
@@ -257,9 +447,10 @@ def log_contains(drv, phrase, write_cache=True):
         build([drv], use_cache=False, write_cache=write_cache)
     except BuildFailure:
         success = False
+    # Already fetched (and cached) by `build` if the build failed.
     log_content = log(drv)
 
-    if phrase in log_content:
+    if log_content is not None and phrase in log_content:
         return "yes"
     elif success:
         return "no_success"
@@ -267,16 +458,55 @@ def log_contains(drv, phrase, write_cache=True):
         return "no_fail"
 
 
+def _query_references(drv):
+    """Asks nix for the immediate dependencies of a single store path."""
+    # Parsed line by line while nix writes them instead of buffering the whole
+    # output first.
+    process = subprocess.Popen(
+        [_NIX_STORE, "--query", "--references", drv],
+        stdout=PIPE,
+        encoding="utf-8",
+        close_fds=False,
+    )
+    with process.stdout:
+        result = [line.rstrip("\n") for line in process.stdout]
+    if process.wait() != 0:
+        raise subprocess.CalledProcessError(process.returncode, process.args)
+    return result
+
+
+# Store paths are immutable, so their references never change.
+_references_cache = dict()
+
+
+def _references_of(drv):
+    """Returns the immediate dependencies of a single store path."""
+    if drv in _references_cache:
+        return _references_cache[drv]
+
+    cache_file = _REFERENCES_DIR.joinpath(Path(drv).name)
+    if cache_file.exists():
+        with open(cache_file, "r") as f:
+            result = f.read().splitlines()
+    else:
+        result = _query_references(drv)
+        _ensure_dir(_REFERENCES_DIR)
+        _write_cache_file(cache_file, "".join(f"{ref}\n" for ref in result))
+    _references_cache[drv] = result
+    return result
+
+
 def references(drvs):
     """Returns all immediate dependencies of `drvs`.
 
-    Runs `nix-store --query --references` internally.
+    Runs `nix-store --query --references` internally. Since the same drv
+    usually shows up in many steps of a bisection, the result is cached on
+    disk.
     """
-    return (
-        subprocess.check_output(["nix-store", "--query", "--references"] + drvs)
-        .decode()
-        .splitlines()
-    )
+    result = set()
+    for drv in drvs:
+        result.update(_references_of(drv))
+    return sorted(result)
 
 
 def build_would_succeed(
@@ -287,16 +517,20 @@ def build_would_succeed(
     use_cache=True,
     write_cache=True,
 ):
-    """Determines build success without actually building if possible"""
+    """Determines build success without actually building if possible
+
+    Like `nix-build-uncached`, nothing is built or fetched when all of `drvs`
+    are already present or can be substituted.
+    """
     rebuilds = build_dry(drvs, nix_options=nix_options)[0]
     rebuild_count = len(rebuilds)
     if rebuild_count == 0:
         return True
 
     blacklisted = []
-    for regex in rebuild_blacklist:
+    for pattern in map(re.compile, rebuild_blacklist):
         for drv_to_rebuild in rebuilds:
-            if re.match(regex, drv_to_rebuild) is not None:
+            if pattern.match(drv_to_rebuild) is not None:
                 blacklisted.append(drv_to_rebuild)
 
     if len(blacklisted) > 0:
@@ -313,17 +547,81 @@ def build_would_succeed(
         return False
 
 
-def build(drvs, nix_options=(), use_cache=True, write_cache=True):
-    """Builds `drvs`, returning a list of store paths"""
-    cache_dir = Path(AppDirs("nix-bisect").user_cache_dir)
-    cache_dir.mkdir(parents=True, exist_ok=True)
-    logs_dir = cache_dir.joinpath("logs")
-    logs_dir.mkdir(exist_ok=True)
+# Known build results, read from disk on first use.
+_build_results = None
+
+
+def _build_result_line(drv, result):
+    """Returns the line recording a build result in `build-results.jsonl`."""
+    return json.dumps({drv: result}, separators=(",", ":")) + "\n"
+
+
+def _load_build_results():
+    """Returns the known build results, only reading them from disk once.
 
-    cache_file = cache_dir.joinpath("build-results.json")
-    if (use_cache or write_cache) and cache_file.exists():
+    The results are stored as one json object per line, so that new results
+    can be appended instead of rewriting the whole file.
+    """
+    global _build_results
+    if _build_results is not None:
+        return _build_results
+    _build_results = dict()
+    cache_file = _CACHE_DIR.joinpath("build-results.jsonl")
+    legacy_file = _CACHE_DIR.joinpath("build-results.json")
+    if not cache_file.exists() and legacy_file.exists():
+        _migrate_build_results(legacy_file, cache_file)
+    if cache_file.exists():
         with open(cache_file, "r") as cf:
-            result_cache = json.loads(cf.read())
+            for line in cf:
+                try:
+                    _build_results.update(json.loads(line))
+                except ValueError:
+                    # A line cut short by an interrupted write.
+                    pass
+    return _build_results
+
+
+def _migrate_build_results(legacy_file, cache_file):
+    """Converts the build results of older versions to JSON lines."""
+    with open(legacy_file, "r") as cf:
+        legacy_results = json.loads(cf.read())
+    with tempfile.NamedTemporaryFile(
+        "w", dir=cache_file.parent, prefix=f"{cache_file.name}.", delete=False
+    ) as f:
+        for (drv, result) in legacy_results.items():
+            f.write(_build_result_line(drv, result))
+    try:
+        # Unlike a rename, linking fails if another process has migrated (and
+        # maybe already appended to) the results in the meantime.
+        os.link(f.name, cache_file)
+    except FileExistsError:
+        pass
+    finally:
+        os.unlink(f.name)
+
+
+def _forget_realized(dry_runs, drvs, nix_options):
+    """Restores the dry runs from before `drvs` were successfully built.
+
+    Everything that the dry run of `drvs` listed is in the store now, so it is
+    removed from the other results. Without that dry run it is unknown what
+    was realized and nothing is restored.
+    """
+    realized = dry_runs.get(_build_dry_key(drvs, nix_options))
+    if realized is None:
+        return
+    realized = set(realized[0] + realized[1])
+    for (key, (to_build, to_fetch)) in dry_runs.items():
+        _build_dry_cache[key] = (
+            [drv for drv in to_build if drv not in realized],
+            [path for path in to_fetch if path not in realized],
+        )
+
+
+def build(drvs, nix_options=(), use_cache=True, write_cache=True):
+    """Builds `drvs`, returning a list of store paths"""
+    if use_cache or write_cache:
+        result_cache = _load_build_results()
     else:
         result_cache = dict()
 
@@ -334,22 +632,34 @@ def build(drvs, nix_options=(), use_cache=True, write_cache=True):
                 print(f"Cached failure of {drv}.")
                 raise BuildFailure(set([drv]))
 
+    _log_cache.clear()
+    # Until the build succeeds, it is unknown what ends up in the store.
+    dry_runs = dict(_build_dry_cache)
+    _build_dry_cache.clear()
     try:
-        return _build_uncached(drvs, nix_options)
+        storepaths = _build_uncached(drvs, nix_options)
+        _forget_realized(dry_runs, drvs, nix_options)
+        return storepaths
     except BuildFailure as bf:
         if write_cache:
-            for drv in bf.drvs_failed:
+            new_results = []
+            for (drv, failure_log) in logs(bf.drvs_failed).items():
                 # Could save more details here in the future if needed.
+                if result_cache.get(drv, True):
+                    new_results.append(_build_result_line(drv, False))
                 result_cache[drv] = False
                 # If the build finished, we know that we can trust the logs are
                 # complete if they are available. This is essential for caching
                 # "skip"s.
-                failure_log = log(drv)
                 if failure_log is not None:
-                    with open(logs_dir.joinpath(Path(drv).name), "w") as f:
+                    _ensure_dir(_LOGS_DIR)
+                    with open(_LOGS_DIR.joinpath(drv.rpartition("/")[2]), "w") as f:
                         f.write(failure_log)
 
-            with open(cache_file, "w") as cf:
-                # Write human-readable json for easy hacking.
-                cf.write(json.dumps(result_cache, indent=4))
+            if len(new_results) > 0:
+                # Only append what we learned. A single write keeps the lines
+                # of concurrent runs from interleaving.
+                _ensure_dir(_CACHE_DIR)
+                with open(_CACHE_DIR.joinpath("build-results.jsonl"), "a") as cf:
+                    cf.write("".join(new_results))
         raise bf
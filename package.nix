@@ -2,8 +2,6 @@
   lib,
   buildPythonPackage,
   appdirs,
-  numpy,
-  pexpect,
 }:
 
 let
@@ -19,8 +17,6 @@ let
 
     propagatedBuildInputs = [
       appdirs
-      numpy
-      pexpect
     ];
 
     passthru.apps = lib.genAttrs apps (script: {
@@ -8,7 +8,7 @@ setup(
     description="Bisect nix builds",
     author="Timo Kaufmann",
     packages=find_packages(),
-    install_requires=["appdirs", "pexpect",],
+    install_requires=["appdirs",],
     entry_points={
         "console_scripts": [
             "nix-build-status=nix_bisect.build_status:_main",